@@ -145,11 +145,15 @@ app_license = "agpl-3.0"
 
 scheduler_events = {
 	"cron": {
-		"* * * * * 0/5": [
+		# Account syncs are triggered on changes, this is only a safety net for missed triggers
+		"*/5 * * * *": [
 			"captain.message_broker.doctype.nats_settings.nats_settings.trigger_sync_accounts",
+		],
+		# Picks up requests made while a batch was running, triggers return early when nothing is pending
+		"* * * * * 0/5": [
 			"captain.message_broker.doctype.nats_user.nats_user.trigger_process_revoke_requests",
 			"captain.message_broker.doctype.nats_user.nats_user.trigger_process_revert_revocation_requests",
-		]
+		],
 	},
 }
 
@@ -196,7 +200,7 @@ scheduler_events = {
 
 # Job Events
 # ----------
-# before_job = ["captain.utils.before_job"]
+before_job = ["captain.utils.jobs.reset_current_job"]
 # after_job = ["captain.utils.after_job"]
 
 # User Data Protection
@@ -1,13 +1,15 @@
 # Copyright (c) 2025, Frappe Cloud and contributors
 # For license information, please see license.txt
 
-from typing import TYPE_CHECKING
+import re
 
 import frappe
 from frappe.model.document import Document
 
-if TYPE_CHECKING:
-	from captain.message_broker.doctype.nats_settings.nats_settings import NATSSettings
+from captain.message_broker.doctype.nats_settings.nats_settings import trigger_sync_accounts
+
+INVALID_ACCOUNT_NAME_CHARS = " @!#$%^&*()+=[]{}|\\;:'\",<>/?."
+_INVALID_ACCOUNT_NAME_RE = re.compile(rf"[\s{re.escape(INVALID_ACCOUNT_NAME_CHARS)}]")
 
 
 class NATSAccount(Document):
@@ -26,38 +28,27 @@ class NATSAccount(Document):
 	# end: auto-generated types
 
 	def before_insert(self):
-		invalid_chars = set(" @!#$%^&*()+=[]{}|\\;:'\",<>/?.")
-		if any((char in invalid_chars) for char in self.account_name):
+		if _INVALID_ACCOUNT_NAME_RE.search(self.account_name):
 			frappe.throw(
-				"Account Name cannot contain spaces or special characters: " + " ".join(invalid_chars)
+				"Account Name cannot contain spaces or special characters: "
+				+ " ".join(INVALID_ACCOUNT_NAME_CHARS)
 			)
 
+	def on_change(self):
+		# Runs on insert, save and db_set
+		if self.pending_sync:
+			frappe.db.after_commit.add(trigger_sync_accounts)
+
 	@frappe.whitelist()
 	def request_sync(self):
-		frappe.db.get_value(self.doctype, self.name, "name", for_update=True)
-
-		self.pending_sync = True
-		self.save(ignore_permissions=True)
-
-	def sync(self):
-		frappe.db.get_value(self.doctype, self.name, "name", for_update=True)
-
-		nats_settings: NATSSettings = frappe.get_doc("NATS Settings", "NATS Settings")
-		if self.revoked:
-			nats_settings.nsc.revoke_account(self.account_name)
-		else:
-			nats_settings.nsc.push_account(self.account_name)
-
-		self.pending_sync = False
-		self.save(ignore_permissions=True)
+		self.db_set("pending_sync", True)
 
 	@frappe.whitelist()
 	def activate(self):
 		if not self.revoked:
 			frappe.throw("Account is already active")
 
-		frappe.db.get_value(self.doctype, self.name, "name", for_update=True)
-
+		# Full save, so that the change is recorded in the document's version history
 		self.revoked = False
 		self.pending_sync = True
 		self.save()
@@ -68,8 +59,7 @@ class NATSAccount(Document):
 		if self.revoked:
 			frappe.throw("Account is already revoked")
 
-		frappe.db.get_value(self.doctype, self.name, "name", for_update=True)
-
+		# Full save, so that the change is recorded in the document's version history
 		self.revoked = True
 		self.pending_sync = True
 		self.save()
@@ -1,14 +1,19 @@
 # Copyright (c) 2025, Frappe Cloud and contributors
 # For license information, please see license.txt
 
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import cached_property
 
 import frappe
-import rq
 from frappe.model.document import Document
+from frappe.utils import now
+from frappe.utils.caching import request_cache
 
 from captain.message_broker.nsc import NSC
-from captain.utils.jobs import has_job_timeout_exceeded
+from captain.utils.jobs import acquire_inflight_key, release_inflight_key
+
+SYNC_ACCOUNTS_INFLIGHT_KEY = "nats:sync_accounts_inflight"
 
 
 class NATSSettings(Document):
@@ -32,9 +37,7 @@ class NATSSettings(Document):
 	# end: auto-generated types
 
 	@cached_property
-	def nsc(self) -> "NSC":
-		from captain.message_broker.nsc import NSC
-
+	def nsc(self) -> NSC:
 		return NSC(self.nsc_directory, self.system_operator)
 
 	@property
@@ -54,12 +57,10 @@ class NATSSettings(Document):
 			frappe.throw("Port cannot be 0")
 
 	def validate_nsc_directory(self):
-		import os
-
 		if not self.nsc_directory:
 			frappe.throw("NSC Directory must be set")
 
-		if not os.path.exists(self.nsc_directory):
+		if not _path_exists(self.nsc_directory):
 			frappe.throw(f"Provided NSC Directory {self.nsc_directory} does not exist")
 
 	def validate_operator_name(self):
@@ -106,11 +107,7 @@ class NATSSettings(Document):
 
 		try:
 			self.nsc.init()
-			# Add an entry in accounts table
-			self.accounts = []
-			self.append(
-				"accounts",
-			)
+			# Add an entry for the operator account
 			frappe.get_doc(
 				{
 					"doctype": "NATS Account",
@@ -188,29 +185,21 @@ class NATSSettings(Document):
 		if not self.is_nsc_initialized:
 			return
 
-		changed = False
-
-		# Sync operator identifier
 		operator_jwt_decoded = self.nsc.get_jwt_dict("operator")
-		if self.operator_id != operator_jwt_decoded.get("sub"):
-			self.operator_id = operator_jwt_decoded.get("sub")
-			self.system_user_id = operator_jwt_decoded.get("nats", {}).get("system_account")
-			changed = True
-
-		# Sync operator account identifier
 		operator_account_jwt_decoded = self.nsc.get_jwt_dict("account", self.system_operator)
-		if self.operator_account_id != operator_account_jwt_decoded.get("sub"):
-			self.operator_account_id = operator_account_jwt_decoded.get("sub")
-			changed = True
-
-		# Sync operator user identifier
 		operator_user_jwt_decoded = self.nsc.get_jwt_dict("user", self.system_operator, self.system_operator)
-		if self.operator_user_id != operator_user_jwt_decoded.get("sub"):
-			self.operator_user_id = operator_user_jwt_decoded.get("sub")
-			changed = True
-
-		if changed:
-			self.save()
+		info = {
+			"operator_id": operator_jwt_decoded.get("sub"),
+			"system_user_id": operator_jwt_decoded.get("nats", {}).get("system_account"),
+			"operator_account_id": operator_account_jwt_decoded.get("sub"),
+			"operator_user_id": operator_user_jwt_decoded.get("sub"),
+		}
+
+		changes = {field: value for field, value in info.items() if self.get(field) != value}
+		if changes:
+			# Only identifiers are synced, so update them directly instead of running the full save cycle
+			self.check_permission("write")
+			self.db_set(changes)
 
 	@frappe.whitelist()
 	def show_nats_server_config(self):
@@ -230,7 +219,12 @@ class NATSSettings(Document):
 		frappe.db.get_value(self.doctype, self.name, "name", for_update=True)
 
 
-def get_nsc() -> "NSC":
+@request_cache
+def _path_exists(path: str) -> bool:
+	return os.path.exists(path)
+
+
+def get_nsc() -> NSC:
 	settings = frappe.get_value(
 		"NATS Settings", None, ["is_nsc_initialized", "nsc_directory", "system_operator"], as_dict=True
 	)
@@ -242,34 +236,127 @@ def get_nsc() -> "NSC":
 	)
 
 
-def sync_accounts():
-	accounts_with_pending_sync = frappe.get_all(
-		"NATS Account", filters={"pending_sync": True}, pluck="name", limit=50
+def sync_accounts(limit: int | None = None, inflight_token: str | None = None):
+	try:
+		synced_count = _sync_accounts(limit)
+	finally:
+		# Allow the job to be enqueued again
+		release_inflight_key(SYNC_ACCOUNTS_INFLIGHT_KEY, inflight_token)
+
+	# Pick up accounts flagged while this batch was running or left out of it
+	# Only when the batch made progress, otherwise retrying is left to the scheduler
+	# e.g. when the account JWT server is unreachable, every run would fail on the same accounts
+	if synced_count:
+		trigger_sync_accounts()
+
+
+def _sync_accounts(limit: int | None = None) -> int:
+	if not limit:
+		limit = _get_sync_batch_size()
+
+	# Only the fields required for syncing are fetched, no need to build the full documents
+	# No row locks, `_mark_accounts_synced` only clears accounts which were not changed since this read
+	accounts = frappe.get_all(
+		"NATS Account",
+		filters={"pending_sync": True},
+		fields=["name", "account_name", "revoked", "modified"],
+		limit=limit,
 	)
-	for account_doc_name in accounts_with_pending_sync:
-		if has_job_timeout_exceeded():
-			break
+	if not accounts:
+		return 0
+
+	# Fetch settings once, so that the cached `nsc` property is reused for the whole batch
+	nats_settings: NATSSettings = frappe.get_cached_doc("NATS Settings", "NATS Settings")
+
+	synced_count, _ = push_accounts(nats_settings.nsc, accounts)
+	return synced_count
+
+
+def push_accounts(nsc: NSC, accounts: list[dict]) -> tuple[int, int]:
+	# Pushes the accounts (name, account_name, revoked, modified) in parallel and clears their pending_sync flag
+	# Returns the number of accounts which synced and failed to sync, failed ones are left pending
+	from rq.timeouts import JobTimeoutException
+
+	if not accounts:
+		return 0, 0
+
+	synced_accounts = []
+	failed_count = 0
+	# Operator selection and the global lock are taken once for the whole batch
+	# The pushes only take their account's lock, so they can run in parallel
+	with nsc.prepare_push():
+		executor = ThreadPoolExecutor(max_workers=min(8, len(accounts)))
+		futures = {
+			executor.submit(nsc.push_prepared, account.account_name, account.revoked): account
+			for account in accounts
+		}
 		try:
-			"""
-			There is no point in syncing parallelly
-			As, we need to take a global lock on NSC directory during any changes
-			For data integrity and avoiding race conditions
-			"""
-			frappe.get_doc("NATS Account", account_doc_name, for_update=True).sync()
-			frappe.db.commit()
-		except rq.timeouts.JobTimeoutException:
-			frappe.db.rollback()
-			return
-		except Exception:
-			frappe.log_error(f"Failed to sync account {account_doc_name}")
-			frappe.db.rollback()
+			for future in as_completed(futures):
+				account = futures[future]
+				try:
+					future.result()
+					synced_accounts.append(account)
+				except Exception:
+					frappe.log_error(f"Failed to sync account {account.name}")
+					failed_count += 1
+		except JobTimeoutException:
+			# Keep the accounts pushed so far, rest will be picked in next run
+			pass
+		finally:
+			executor.shutdown(wait=False, cancel_futures=True)
+
+	_mark_accounts_synced(synced_accounts)
+	return len(synced_accounts), failed_count
+
+
+def _get_sync_batch_size() -> int:
+	# Drain large backlogs (e.g. bulk activation) faster, while keeping small batches otherwise
+	pending_count = frappe.db.count("NATS Account", {"pending_sync": True})
+	if pending_count <= 50:
+		return 50
+	if pending_count <= 200:
+		return 200
+	return 500
+
+
+def _mark_accounts_synced(accounts: list[dict]):
+	if not accounts:
+		return
+
+	# Only clear the flag if the account was not changed while its state was being pushed
+	# Every re-flag (revoke / activate, user revocations, request_sync) bumps `modified`
+	frappe.db.sql(
+		"""
+		UPDATE `tabNATS Account`
+		SET pending_sync = 0, modified = %(modified)s
+		WHERE (name, modified) IN %(versions)s
+		""",
+		{
+			"versions": tuple((account.name, account.modified) for account in accounts),
+			"modified": now(),
+		},
+	)
+	frappe.db.commit()
 
 
 def trigger_sync_accounts():
-	frappe.enqueue(
-		"captain.message_broker.doctype.nats_settings.nats_settings.sync_accounts",
-		queue="default",
-		timeout=300,
-		job_id="nats||sync_accounts",
-		deduplicate=True,
-	)
+	# Avoid creating a job every tick, when there is nothing to sync
+	if not frappe.db.sql("SELECT 1 FROM `tabNATS Account` WHERE pending_sync = 1 LIMIT 1"):
+		return
+
+	# Single SET NX instead of RQ's job lookup
+	# No fixed job_id, as the running job re-triggers itself and would overwrite its own job hash
+	inflight_token = acquire_inflight_key(SYNC_ACCOUNTS_INFLIGHT_KEY)
+	if not inflight_token:
+		return
+
+	try:
+		frappe.enqueue(
+			"captain.message_broker.doctype.nats_settings.nats_settings.sync_accounts",
+			queue="default",
+			timeout=300,
+			inflight_token=inflight_token,
+		)
+	except Exception:
+		release_inflight_key(SYNC_ACCOUNTS_INFLIGHT_KEY, inflight_token)
+		raise
@@ -1,9 +1,14 @@
 # Copyright (c) 2025, Frappe Cloud and Contributors
 # See license.txt
 
-# import frappe
+import contextlib
+from unittest.mock import patch
+
+import frappe
 from frappe.tests import IntegrationTestCase
 
+from captain.message_broker.doctype.nats_settings.nats_settings import push_accounts
+
 # On IntegrationTestCase, the doctype test records and all
 # link-field test record dependencies are recursively loaded
 # Use these module variables to add/remove to/from that list
@@ -11,6 +16,20 @@ EXTRA_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 IGNORE_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 
 
+class FakeNSC:
+	def __init__(self, after_push=None):
+		self.after_push = after_push
+
+	@contextlib.contextmanager
+	def prepare_push(self):
+		yield
+		# Runs once every account of the batch is pushed, before their pending_sync flag is cleared
+		if self.after_push:
+			self.after_push()
+
+	def push_prepared(self, account_name: str, revoked: bool = False):
+		pass
+
 
 class IntegrationTestNATSSettings(IntegrationTestCase):
 	"""
@@ -18,4 +37,32 @@ class IntegrationTestNATSSettings(IntegrationTestCase):
 	Use this class for testing interactions between multiple components.
 	"""
 
-	pass
+	def setUp(self):
+		self.account = frappe.get_doc(
+			{
+				"doctype": "NATS Account",
+				"account_name": f"test{frappe.generate_hash(length=8)}",
+				"pending_sync": True,
+			}
+		).insert(ignore_permissions=True)
+
+	def _push_accounts(self, nsc: FakeNSC) -> int:
+		accounts = frappe.get_all(
+			"NATS Account",
+			filters={"name": self.account.name},
+			fields=["name", "account_name", "revoked", "modified"],
+		)
+		# Keep the test records inside the test transaction
+		with patch.object(frappe.db, "commit"):
+			push_accounts(nsc, accounts)
+		return frappe.db.get_value("NATS Account", self.account.name, "pending_sync")
+
+	def test_push_accounts_clears_pending_sync(self):
+		self.assertEqual(self._push_accounts(FakeNSC()), 0)
+
+	def test_push_accounts_keeps_accounts_flagged_again_during_the_batch(self):
+		# e.g. a user revocation edits the account JWT and flags the account while the batch is pushed
+		def flag_again():
+			frappe.db.set_value("NATS Account", self.account.name, "pending_sync", True)
+
+		self.assertEqual(self._push_accounts(FakeNSC(after_push=flag_again)), 1)
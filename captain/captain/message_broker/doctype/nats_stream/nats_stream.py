@@ -4,7 +4,7 @@
 import frappe
 from frappe.model.document import Document
 
-from captain.message_broker.nats import NatsClient
+from captain.message_broker.nats import get_client
 
 
 class NATSStream(Document):
@@ -25,16 +25,32 @@ class NATSStream(Document):
 
 	def before_insert(self):
 		# Check for stream uniqueness
-		if frappe.db.exists("NATS Stream", {"account": self.account, "stream": self.stream}):
+		if frappe.db.sql(
+			"SELECT 1 FROM `tabNATS Stream` WHERE stream = %s AND account = %s LIMIT 1",
+			(self.stream, self.account),
+		):
 			frappe.throw(f"Stream {self.stream} already exists for account {self.account}.")
 
+	@property
+	def subject_list(self) -> list[str]:
+		return [s.subject for s in self.subjects]
+
 	def on_update(self):
-		with NatsClient(user=self.account, account=self.account) as client:
-			if self.flags.in_insert:
-				client.create_stream(self.stream, [s.subject for s in self.subjects])
-			else:
-				client.update_stream(self.stream, [s.subject for s in self.subjects])
+		if not self.flags.in_insert and not self.has_subjects_changed():
+			# Nothing to update on NATS server
+			return
+
+		client = get_client(user=self.account, account=self.account)
+		if self.flags.in_insert:
+			client.create_stream(self.stream, self.subject_list)
+		else:
+			client.update_stream(self.stream, self.subject_list)
+
+	def has_subjects_changed(self) -> bool:
+		doc_before_save: NATSStream | None = self.get_doc_before_save()
+		if not doc_before_save:
+			return True
+		return sorted(doc_before_save.subject_list) != sorted(self.subject_list)
 
 	def on_trash(self):
-		with NatsClient(user=self.account, account=self.account) as client:
-			client.delete_stream(self.stream)
+		get_client(user=self.account, account=self.account).delete_stream(self.stream)
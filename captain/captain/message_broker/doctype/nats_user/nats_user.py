@@ -1,11 +1,27 @@
 # Copyright (c) 2025, Frappe Cloud and contributors
 # For license information, please see license.txt
 
+from collections import defaultdict
+from collections.abc import Callable
+from typing import TYPE_CHECKING
+
 import frappe
 from frappe.model.document import Document
+from frappe.utils import now
+
+from captain.message_broker.doctype.nats_settings.nats_settings import (
+	get_nsc,
+	push_accounts,
+	trigger_sync_accounts,
+)
+from captain.utils.jobs import acquire_inflight_key, has_job_timeout_exceeded, release_inflight_key
+
+if TYPE_CHECKING:
+	from captain.message_broker.nsc import NSC
 
-from captain.message_broker.doctype.nats_settings.nats_settings import get_nsc
-from captain.utils.jobs import has_job_timeout_exceeded
+PENDING_USERS_BATCH_SIZE = 50
+PROCESS_REVOKE_REQUESTS_INFLIGHT_KEY = "nats:process_revoke_requests_inflight"
+PROCESS_REVERT_REVOCATION_REQUESTS_INFLIGHT_KEY = "nats:process_revert_revocation_requests_inflight"
 
 
 class NATSUser(Document):
@@ -28,15 +44,26 @@ class NATSUser(Document):
 
 	@property
 	def pub_subjects(self) -> list[str]:
-		return [s.subject for s in self.subjects if s.type in ("Publish", "PubSub")]
+		return self._split_subjects()[0]
 
 	@property
 	def sub_subjects(self) -> list[str]:
-		return [s.subject for s in self.subjects if s.type in ("Subscribe", "PubSub")]
+		return self._split_subjects()[1]
+
+	def _split_subjects(self) -> tuple[list[str], list[str]]:
+		# Returns (pub, sub) subjects in a single pass
+		pub, sub = [], []
+		for s in self.subjects:
+			if s.type == "Publish" or s.type == "PubSub":
+				pub.append(s.subject)
+			if s.type == "Subscribe" or s.type == "PubSub":
+				sub.append(s.subject)
+		return pub, sub
 
 	def after_insert(self):
 		nsc = get_nsc()
-		self.user_id = nsc.add_user(self.account, self.name, pub=self.pub_subjects, sub=self.sub_subjects)
+		pub, sub = self._split_subjects()
+		self.user_id = nsc.add_user(self.account, self.name, pub=pub, sub=sub)
 		self.db_update()
 
 	def on_update(self):
@@ -50,7 +77,8 @@ class NATSUser(Document):
 		if self.has_value_changed("subjects"):
 			# Subjects have changed, update user permissions
 			nsc = get_nsc()
-			nsc.update_user_permissions(self.account, self.name, pub=self.pub_subjects, sub=self.sub_subjects)
+			pub, sub = self._split_subjects()
+			nsc.update_user_permissions(self.account, self.name, pub=pub, sub=sub)
 
 	def on_trash(self):
 		nsc = get_nsc()
@@ -75,6 +103,7 @@ class NATSUser(Document):
 
 		self.status = "Revocation Pending"
 		self.save()
+		frappe.db.after_commit.add(trigger_process_revoke_requests)
 
 		frappe.msgprint("Revocation request submitted. Please wait for the process to complete.")
 
@@ -85,89 +114,169 @@ class NATSUser(Document):
 
 		self.status = "Revert Revocation Pending"
 		self.save()
+		frappe.db.after_commit.add(trigger_process_revert_revocation_requests)
 
 		frappe.msgprint("Revert revocation request submitted. Please wait for the process to complete.")
 
 
-def process_revoke_requests():
-	pending_users = frappe.get_all(
-		"NATS User",
-		filters={"status": "Revocation Pending"},
-		fields=["name", "account"],
-		limit_page_length=50,
+def process_revoke_requests(inflight_token: str | None = None):
+	try:
+		nsc = get_nsc()
+		has_more = _process_pending_users(
+			nsc,
+			status="Revocation Pending",
+			new_status="Revoked",
+			process=nsc.revoke_users_bulk,
+			account_failure_message="Failed to revoke users of account",
+			user_failure_message="Failed to revoke user",
+		)
+	finally:
+		# Allow the job to be enqueued again
+		release_inflight_key(PROCESS_REVOKE_REQUESTS_INFLIGHT_KEY, inflight_token)
+
+	if has_more:
+		trigger_process_revoke_requests()
+
+
+def process_revert_revocation_requests(inflight_token: str | None = None):
+	try:
+		nsc = get_nsc()
+		has_more = _process_pending_users(
+			nsc,
+			status="Revert Revocation Pending",
+			new_status="Active",
+			process=nsc.remove_user_revocations_bulk,
+			account_failure_message="Failed to reinstate users of account",
+			user_failure_message="Failed to reinstate user",
+		)
+	finally:
+		# Allow the job to be enqueued again
+		release_inflight_key(PROCESS_REVERT_REVOCATION_REQUESTS_INFLIGHT_KEY, inflight_token)
+
+	if has_more:
+		trigger_process_revert_revocation_requests()
+
+
+def _process_pending_users(
+	nsc: "NSC",
+	status: str,
+	new_status: str,
+	process: Callable[..., dict[str, Exception | None]],
+	account_failure_message: str,
+	user_failure_message: str,
+) -> bool:
+	# Returns whether the batch made progress and users were left out of it, by the batch size or the job timeout
+	# Without progress, retrying is left to the scheduler, so persistently failing users don't run in a tight loop
+	# Plain tuples, only needed to group users by account
+	# Oldest requests first, failed users are moved to the back of the queue below
+	pending_users = frappe.db.sql(
+		"SELECT name, account FROM `tabNATS User` WHERE status = %s ORDER BY modified LIMIT %s",
+		(status, PENDING_USERS_BATCH_SIZE),
 	)
+	users_by_account = defaultdict(list)
+	for name, account in pending_users:
+		users_by_account[account].append(name)
+
 	accounts = set()
-	nsc = get_nsc()
-	for user in pending_users:
+	processed_users = []
+	failed_users = []
+	for account, user_names in users_by_account.items():
+		# Leave remaining users for the next run
+		if has_job_timeout_exceeded():
+			break
 		try:
-			nsc.revoke_user(user.account, user.name)
-			frappe.db.set_value("NATS User", user.name, "status", "Revoked")
-			accounts.add(user.account)
-			frappe.db.commit()
+			errors = process(account, user_names, should_stop=has_job_timeout_exceeded)
 		except Exception as e:
-			frappe.log_error(f"Failed to revoke user {user.name}: {e}")
-			frappe.db.rollback()
-
-	# Trigger account sync for affected accounts
-	for account in accounts:
-		if has_job_timeout_exceeded():
+			frappe.log_error(f"{account_failure_message} {account}: {e}")
+			failed_users.extend(user_names)
 			continue
 
-		# Take lock
-		frappe.db.get_value("NATS Account", account, "name", for_update=True)
-
-		# Set pending_sync to True
-		frappe.db.set_value("NATS Account", account, "pending_sync", True)
+		for user_name, error in errors.items():
+			if error:
+				frappe.log_error(f"{user_failure_message} {user_name}: {error}")
+				failed_users.append(user_name)
+			else:
+				processed_users.append(user_name)
+				accounts.add(account)
+
+	if failed_users:
+		# Let the remaining requests go first in the next runs
+		frappe.db.sql(
+			"UPDATE `tabNATS User` SET modified = %(modified)s WHERE name IN %(names)s",
+			{"modified": now(), "names": tuple(failed_users)},
+		)
 		frappe.db.commit()
 
+	if not processed_users:
+		return False
+
+	has_more = len(pending_users) == PENDING_USERS_BATCH_SIZE or has_job_timeout_exceeded()
 
-def process_revert_revocation_requests():
-	pending_users = frappe.get_all(
-		"NATS User",
-		filters={"status": "Revert Revocation Pending"},
-		fields=["name", "account"],
-		limit_page_length=50,
+	# Whole batch is written in a single transaction
+	frappe.db.sql(
+		"UPDATE `tabNATS User` SET status = %(status)s, modified = %(modified)s WHERE name IN %(names)s",
+		{"status": new_status, "modified": now(), "names": tuple(processed_users)},
 	)
-	accounts = set()
-	nsc = get_nsc()
-	for user in pending_users:
-		try:
-			nsc.remove_user_revocation(user.account, user.name)
-			frappe.db.set_value("NATS User", user.name, "status", "Active")
-			accounts.add(user.account)
-			frappe.db.commit()
-		except Exception as e:
-			frappe.log_error(f"Failed to reinstate user {user.name}: {e}")
-			frappe.db.rollback()
 
 	# Trigger account sync for affected accounts
-	for account in accounts:
-		if has_job_timeout_exceeded():
-			continue
-
-		# Take lock
-		frappe.db.get_value("NATS Account", account, "name", for_update=True)
+	frappe.db.sql(
+		"""
+		UPDATE `tabNATS Account`
+		SET pending_sync = 1, modified = %(modified)s
+		WHERE name IN %(accounts)s
+		""",
+		{"modified": now(), "accounts": tuple(accounts)},
+	)
+	frappe.db.commit()
+
+	if has_job_timeout_exceeded():
+		# Leave the push to the account sync job
+		trigger_sync_accounts()
+		return has_more
+
+	# Push the affected accounts right away instead of waiting for the account sync job
+	affected_accounts = frappe.db.sql(
+		"SELECT name, account_name, revoked, modified FROM `tabNATS Account` WHERE name IN %(accounts)s",
+		{"accounts": tuple(accounts)},
+		as_dict=True,
+	)
+	_, failed_count = push_accounts(nsc, affected_accounts)
+	if failed_count:
+		# Retry the failed ones through the account sync job
+		trigger_sync_accounts()
 
-		# Set pending_sync to True
-		frappe.db.set_value("NATS Account", account, "pending_sync", True)
-		frappe.db.commit()
+	return has_more
 
 
 def trigger_process_revoke_requests():
-	frappe.enqueue(
-		"captain.message_broker.doctype.nats_user.nats_user.process_revoke_requests",
-		queue="default",
-		timeout=300,
-		job_id="nats||process_revoke_requests",
-		enqueue_after_commit=True,
-	)
+	_enqueue_processor("process_revoke_requests", "Revocation Pending", PROCESS_REVOKE_REQUESTS_INFLIGHT_KEY)
 
 
 def trigger_process_revert_revocation_requests():
-	frappe.enqueue(
-		"captain.message_broker.doctype.nats_user.nats_user.process_revert_revocation_requests",
-		queue="default",
-		timeout=300,
-		job_id="nats||process_revert_revocation_requests",
-		enqueue_after_commit=True,
+	_enqueue_processor(
+		"process_revert_revocation_requests",
+		"Revert Revocation Pending",
+		PROCESS_REVERT_REVOCATION_REQUESTS_INFLIGHT_KEY,
 	)
+
+
+def _enqueue_processor(method: str, status: str, inflight_key: str):
+	# Avoid creating a job every tick, when there is nothing to process
+	if not frappe.db.sql("SELECT 1 FROM `tabNATS User` WHERE status = %s LIMIT 1", (status,)):
+		return
+
+	# Same gate as `trigger_sync_accounts`, RQ's deduplication would also drop the re-trigger from the running job
+	inflight_token = acquire_inflight_key(inflight_key)
+	if not inflight_token:
+		return
+
+	try:
+		frappe.enqueue(
+			f"captain.message_broker.doctype.nats_user.nats_user.{method}",
+			queue="default",
+			timeout=300,
+			inflight_token=inflight_token,
+		)
+	except Exception:
+		release_inflight_key(inflight_key, inflight_token)
+		raise
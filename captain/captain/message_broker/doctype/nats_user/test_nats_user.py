@@ -1,9 +1,13 @@
 # Copyright (c) 2025, Frappe Cloud and Contributors
 # See license.txt
 
+import copy
+from unittest.mock import patch
+
 # import frappe
-from frappe.tests import IntegrationTestCase
+from frappe.tests import IntegrationTestCase, UnitTestCase
 
+from captain.message_broker.nsc import NSC
 
 # On IntegrationTestCase, the doctype test records and all
 # link-field test record dependencies are recursively loaded
@@ -12,6 +16,72 @@ EXTRA_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 IGNORE_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 
 
+class UnitTestNATSUser(UnitTestCase):
+	"""
+	Unit tests for NATSUser.
+	Use this class for testing individual functions and methods.
+	"""
+
+	def setUp(self):
+		self.nsc = NSC(nsc_directory="/tmp/nsc", operator="test")
+		self.permissions = {"pub": {"allow": [], "deny": []}, "sub": {"allow": [], "deny": []}}
+		self.commands = []
+
+	def _run_nsc_command(self, args, set_operator=True, capture_stdout=False):
+		# Applies `nsc edit user` to the stored permissions, `--rm` drops the subject from every rule
+		self.commands.append(args)
+		options = dict(zip(args[5::2], args[6::2], strict=True))
+		for subject in options.get("--rm", "").split(","):
+			for rules in self.permissions.values():
+				for subjects in rules.values():
+					if subject in subjects:
+						subjects.remove(subject)
+
+		for option, kind in (("--allow-pub", "pub"), ("--allow-sub", "sub")):
+			for subject in options.get(option, "").split(","):
+				if subject and subject not in self.permissions[kind]["allow"]:
+					self.permissions[kind]["allow"].append(subject)
+		return ""
+
+	def _get_jwt_dict(self, entity_type, account_name=None, user_name=None):
+		return {"nats": copy.deepcopy(self.permissions)}
+
+	def _update_user_permissions(self, pub, sub):
+		with (
+			patch.object(self.nsc, "_run_nsc_command", side_effect=self._run_nsc_command),
+			patch.object(self.nsc, "get_jwt_dict", side_effect=self._get_jwt_dict),
+		):
+			self.nsc.update_user_permissions("account", "user", pub=pub, sub=sub)
+
+	def test_update_user_permissions_moves_subject_from_pub_to_sub(self):
+		self.permissions["pub"]["allow"] = ["orders", "events"]
+		self.permissions["sub"]["allow"] = ["events"]
+
+		self._update_user_permissions(pub=["events"], sub=["orders", "events"])
+
+		self.assertCountEqual(self.permissions["pub"]["allow"], ["events"])
+		self.assertCountEqual(self.permissions["sub"]["allow"], ["orders", "events"])
+
+	def test_update_user_permissions_removes_denied_subjects(self):
+		self.permissions["pub"]["allow"] = ["orders"]
+		self.permissions["pub"]["deny"] = ["orders.internal"]
+		self.permissions["sub"]["deny"] = ["events"]
+
+		self._update_user_permissions(pub=["orders"], sub=["events"])
+
+		self.assertCountEqual(self.permissions["pub"]["allow"], ["orders"])
+		self.assertCountEqual(self.permissions["sub"]["allow"], ["events"])
+		self.assertEqual(self.permissions["pub"]["deny"], [])
+		self.assertEqual(self.permissions["sub"]["deny"], [])
+
+	def test_update_user_permissions_skips_unchanged_permissions(self):
+		self.permissions["pub"]["allow"] = ["orders", "events"]
+		self.permissions["sub"]["allow"] = ["events"]
+
+		self._update_user_permissions(pub=["events", "orders"], sub=["events"])
+
+		self.assertEqual(self.commands, [])
+
 
 class IntegrationTestNATSUser(IntegrationTestCase):
 	"""
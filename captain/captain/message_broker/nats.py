@@ -1,20 +1,44 @@
 import asyncio
+import atexit
+import contextlib
+import os
+import threading
+from typing import ClassVar
 
 import frappe
 import nats
-import nest_asyncio
 
 from captain.message_broker.nsc import NSC
 
+# Event loop running in a background thread, all NATS coroutines of this process are run on it
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_pid: int | None = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+	global _loop, _loop_pid
+
+	with _loop_lock:
+		# Threads don't survive a fork, so start a new loop in the child process
+		if _loop is None or _loop_pid != os.getpid():
+			_loop = asyncio.new_event_loop()
+			threading.Thread(target=_loop.run_forever, name="nats-event-loop", daemon=True).start()
+			_loop_pid = os.getpid()
+		return _loop
+
 
 class NatsClient:
-	_nest_asyncio_applied = False
+	# (url, account, user) -> connected client, shared for the lifetime of the process
+	_shared_clients: ClassVar[dict[tuple[str, str, str], "NatsClient"]] = {}
+	_shared_clients_pid: int | None = None
+	_shared_clients_lock = threading.Lock()
 
 	def __init__(self, user: str | None = None, account: str | None = None):
-		settings = frappe.get_value(
-			"NATS Settings", None, ["host", "port", "nsc_directory", "system_operator"], as_dict=True
-		)
-		self.url = f"nats://{settings.host}:{settings.port}"
+		# Cached doc is invalidated on save of NATS Settings
+		settings = frappe.get_cached_doc("NATS Settings", "NATS Settings")
+		self.url = _get_url(settings)
+		self.is_shared = False
 		self.nsc = NSC(
 			nsc_directory=settings.nsc_directory,
 			operator=settings.system_operator,
@@ -23,37 +47,67 @@ class NatsClient:
 		self.user = user or self.system_operator
 		self.account = account or self.system_operator
 		self.nc: nats.NATS = None
-
-		# Apply nest_asyncio only once
-		if not NatsClient._nest_asyncio_applied:
-			# Patch asyncio globally to allow nested event loops -- Multiple calls are redundant but safe
-			nest_asyncio.apply()
-			NatsClient._nest_asyncio_applied = True
-
-		# Get or create event loop - don't create a new one if one exists
-		try:
-			self.loop = asyncio.get_running_loop()
-		except RuntimeError:
-			self.loop = asyncio.new_event_loop()
-			asyncio.set_event_loop(self.loop)
+		# Connecting is done outside the shared clients lock, so one slow server doesn't block other clients
+		self._connect_lock = threading.Lock()
+
+	@classmethod
+	def get_shared(cls, user: str | None = None, account: str | None = None) -> "NatsClient":
+		"""
+		Returns a connected client, which is reused across requests / jobs of this process.
+		Connection setup is costlier than most of the operations done with it.
+		"""
+		settings = frappe.get_cached_doc("NATS Settings", "NATS Settings")
+		key = (
+			_get_url(settings),
+			account or settings.system_operator,
+			user or settings.system_operator,
+		)
+		with cls._shared_clients_lock:
+			# Connections inherited from the parent process are bound to its event loop thread
+			if cls._shared_clients_pid != os.getpid():
+				cls._shared_clients = {}
+				cls._shared_clients_pid = os.getpid()
+
+			client = cls._shared_clients.get(key)
+			if not client:
+				client = cls(user=user, account=account)
+				client.is_shared = True
+				cls._shared_clients[key] = client
+
+		client.connect()
+		return client
+
+	@classmethod
+	def _close_all(cls):
+		with cls._shared_clients_lock:
+			for client in cls._shared_clients.values():
+				with contextlib.suppress(Exception):
+					client.close()
+			cls._shared_clients.clear()
 
 	def _run_async(self, coro):
-		"""Helper method to safely run async code"""
-		return self.loop.run_until_complete(coro)
+		"""Helper method to run async code on the background event loop and wait for the result"""
+		return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
 
 	def connect(self):
 		async def _connect():
+			if self.nc:
+				# Dropped connection may still be reconnecting, stop its tasks before replacing it
+				with contextlib.suppress(Exception):
+					await self.nc.close()
+				self.nc = None
+
 			self.nc = await nats.connect(
 				self.url,
 				user_credentials=self.nsc.get_user_credential_path(self.account, self.user),
 			)
 			await self.nc.flush()
 
-		if self.loop and self.loop.is_closed():
-			self.loop = asyncio.new_event_loop()
-			asyncio.set_event_loop(self.loop)
+		with self._connect_lock:
+			if self.nc and self.nc.is_connected:
+				return
 
-		self._run_async(_connect())
+			self._run_async(_connect())
 
 	def close(self):
 		async def _close():
@@ -64,10 +118,6 @@ class NatsClient:
 		if self.nc:
 			self._run_async(_close())
 
-		# Only close loop if it's not running and we created it
-		if not self.loop.is_running() and not self.loop.is_closed():
-			self.loop.close()
-
 	# Subscription handlers
 	# ----------------------
 	def subscribe(self, subject, cb):
@@ -119,4 +169,17 @@ class NatsClient:
 		return self
 
 	def __exit__(self, exc_type, exc_value, traceback):
-		self.close()
+		# Shared clients are closed on process exit
+		if not self.is_shared:
+			self.close()
+
+
+def _get_url(settings) -> str:
+	return f"nats://{settings.host}:{settings.port}"
+
+
+def get_client(user: str | None = None, account: str | None = None) -> NatsClient:
+	return NatsClient.get_shared(user=user, account=account)
+
+
+atexit.register(NatsClient._close_all)
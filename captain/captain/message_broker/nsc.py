@@ -1,17 +1,59 @@
+import base64
 import contextlib
 import os
+import string
 import subprocess
+import threading
+from collections.abc import Callable
 from functools import wraps
 from typing import Literal
 
 import filelock
+import orjson
 
+_NATS_SERVER_CONFIG_TEMPLATE = string.Template("""
+operator: $operator_jwt
 
-def with_global_lock():
+system_account: $system_account_public_key
+
+resolver {
+    type: full
+    dir: '/data/jwt'
+    allow_delete: true
+    interval: "2m"
+    timeout: "1.9s"
+}
+
+resolver_preload: {
+	$system_account_public_key: $system_account_jwt,
+}
+""")
+
+# Operators already selected by this process, as (pid, nsc directory, operator)
+# Selection is persisted in nsc's context, so it needs to be done only once per process
+_selected_operators: set[tuple[int, str, str]] = set()
+
+
+# In-process locks by lock file path, so threads of the same process don't contend on the file lock
+# Re-entrant, as locked methods call each other (e.g. add_account -> push_account)
+_thread_locks: dict[str, threading.RLock] = {}
+_thread_locks_guard = threading.Lock()
+
+
+def _get_thread_lock(lock_file: str) -> threading.RLock:
+	with _thread_locks_guard:
+		if lock_file not in _thread_locks:
+			_thread_locks[lock_file] = threading.RLock()
+		return _thread_locks[lock_file]
+
+
+def with_lock(key_fn: Callable[..., str] | None = None):
+	# `key_fn` receives the method's arguments and returns the lock key, defaults to the global lock
 	def decorator(func):
 		@wraps(func)
 		def wrapper(self, *args, **kwargs):
-			with self.global_lock():
+			key = key_fn(self, *args, **kwargs) if key_fn else "global"
+			with self.lock(key):
 				return func(self, *args, **kwargs)
 
 		return wrapper
@@ -19,17 +61,40 @@ def with_global_lock():
 	return decorator
 
 
+def with_global_lock():
+	return with_lock()
+
+
+def with_account_lock():
+	# Only for changes limited to the account's own JWT (pushes, user revocations)
+	# Adding / deleting an account also writes nsc's context and the operator store, so those take the global lock
+	def key_fn(self, *args, **kwargs) -> str:
+		return _account_lock_key(kwargs["account_name"] if "account_name" in kwargs else args[0])
+
+	return with_lock(key_fn)
+
+
+def _account_lock_key(account_name: str) -> str:
+	return f"account-{account_name}"
+
+
 class NSC:
 	# Initialization Methods
 	# -----------------------
 	def __init__(self, nsc_directory: str, operator: str) -> None:
 		self.nsc_directory = nsc_directory
 		self._locks_directory = os.path.join(nsc_directory, "locks")
-		self._operator_lock_file = os.path.join(self._locks_directory, "operator.lock")
 		self.operator = operator
+		# Precomputed, as JWT / creds paths are resolved multiple times for every nsc operation
+		self._operator_folder = os.path.join(nsc_directory, operator)
+		self._accounts_folder = os.path.join(self._operator_folder, "accounts")
+		self._creds_folder = os.path.join(nsc_directory, "creds", operator)
 		self.sys_account = "SYS"
 		self.sys_user = "sys"
-		self._global_lock = None
+		self._file_locks: dict[str, filelock.FileLock] = {}
+		self._is_initialized = False
+		# JWT path -> ((mtime in ns, size, inode), decoded payload)
+		self._jwt_cache: dict[str, tuple[tuple[int, int, int], dict]] = {}
 
 	def init(self):
 		if not os.path.exists(self.nsc_directory):
@@ -64,12 +129,17 @@ class NSC:
 			raise e
 
 	def is_initialized(self) -> bool:
+		# Once initialized, the directory stays initialized until `cleanup`, so avoid probing it again
+		if self._is_initialized:
+			return True
+
 		if not os.path.exists(self.nsc_directory):
 			return False
 		files = os.listdir(self.nsc_directory)
 		# Filter out .gitignore and lock folder
 		files = [f for f in files if f not in [".gitignore", "locks"]]
 		if files:
+			self._is_initialized = True
 			return True
 		return False
 
@@ -78,6 +148,7 @@ class NSC:
 	@with_global_lock()
 	def set_account_jwt_server_url(self, url: str):
 		self._run_nsc_command(["edit", "operator", "--account-jwt-server-url", url])
+		self._forget_jwt("operator")
 
 	# Account CRUD Methods
 	# -----------------------
@@ -100,6 +171,7 @@ class NSC:
 					"--js-enable=0",
 				]
 			)
+			self._forget_jwt("account", account_name)
 
 			# Create user with same name as admin account
 			self.add_user(account_name, account_name, pub=[">"], sub=[">"])
@@ -111,7 +183,11 @@ class NSC:
 			self.delete_account(account_name)
 			raise Exception(f"Failed to create account {account_name}") from e
 
-	def is_exist_account(self, account_name: str) -> bool:
+	def is_exist_account(self, account_name: str, strict: bool = False) -> bool:
+		# JWT location is deterministic, `strict` also validates the account through nsc
+		if not strict:
+			return os.path.exists(self.get_jwt_path("account", account_name))
+
 		try:
 			self._run_nsc_command(["describe", "account", account_name])
 			return True
@@ -126,6 +202,21 @@ class NSC:
 	def revoke_account(self, account_name: str):
 		self._run_nsc_command(["push", "-R", account_name])
 
+	@contextlib.contextmanager
+	def prepare_push(self):
+		# Pushes read the operator JWT, so the global lock is held for the whole batch
+		# That keeps operator edits and account additions / deletions out, while `push_prepared` runs in parallel
+		with self.global_lock():
+			# Done once upfront, so the pushes can skip it
+			self._select_operator()
+			yield
+
+	@with_account_lock()
+	def push_prepared(self, account_name: str, revoked: bool = False):
+		# Only reads the account and operator JWTs and talks to the account JWT server
+		# So, multiple accounts can be pushed in parallel from within `prepare_push`
+		self._run_nsc_command(["push", "-R" if revoked else "-a", account_name], set_operator=False)
+
 	@with_global_lock()
 	def delete_account(self, account_name: str) -> bool:
 		account_jwt_path = self.get_jwt_path("account", account_name)
@@ -154,6 +245,7 @@ class NSC:
 				self._run_nsc_command(
 					["add", "user", user_name, "--account", account_name, "--allow-pub-response=-1"]
 				)  # enable pub response by default
+				self._forget_jwt("user", account_name, user_name)
 
 			# Update user permissions
 			self.update_user_permissions(account_name, user_name, pub, sub)
@@ -184,12 +276,18 @@ class NSC:
 		current_allowed_sub = nats_info.get("sub", {}).get("allow", [])
 		current_denied_sub = nats_info.get("sub", {}).get("deny", [])
 
-		all_pub_sub = set(
-			current_allowed_pub + current_denied_pub + current_allowed_sub + current_denied_sub + pub + sub
+		# Subjects which are in a rule they should not be in
+		# `--rm` removes the subject from every rule, so such subjects are re-added below if still required
+		to_remove = (
+			(set(current_allowed_pub) - set(pub))
+			| (set(current_allowed_sub) - set(sub))
+			| set(current_denied_pub)
+			| set(current_denied_sub)
 		)
+		pub_to_add = [s for s in dict.fromkeys(pub) if s not in current_allowed_pub or s in to_remove]
+		sub_to_add = [s for s in dict.fromkeys(sub) if s not in current_allowed_sub or s in to_remove]
 
-		# Remove all existing subject from any rule
-		if all_pub_sub:
+		if to_remove:
 			self._run_nsc_command(
 				[
 					"edit",
@@ -198,11 +296,12 @@ class NSC:
 					"-a",
 					account_name,
 					"--rm",
-					",".join(all_pub_sub),
+					",".join(sorted(to_remove)),
 				]
 			)
+			self._forget_jwt("user", account_name, user_name)
 
-		if not pub and not sub:
+		if not pub_to_add and not sub_to_add:
 			return
 
 		# Add new rules
@@ -214,12 +313,13 @@ class NSC:
 			account_name,
 		]
 
-		if pub:
-			cmd += ["--allow-pub", ",".join(pub)]
-		if sub:
-			cmd += ["--allow-sub", ",".join(sub)]
+		if pub_to_add:
+			cmd += ["--allow-pub", ",".join(pub_to_add)]
+		if sub_to_add:
+			cmd += ["--allow-sub", ",".join(sub_to_add)]
 
 		self._run_nsc_command(cmd)
+		self._forget_jwt("user", account_name, user_name)
 
 	def delete_user(self, account_name: str, user_name: str, revoke: bool = True):
 		user_jwt_path = self.get_jwt_path("user", account_name=account_name, user_name=user_name)
@@ -239,22 +339,22 @@ class NSC:
 			cmd.append("--revoke")
 
 		self._run_nsc_command(cmd)
+		self._forget_jwt("user", account_name, user_name)
 
 	def revoke_user(self, account_name: str, user_name: str):
-		user_jwt_path = self.get_jwt_path("user", account_name=account_name, user_name=user_name)
-		if not os.path.exists(user_jwt_path):
-			return
+		self._update_user_revocation("add-user", account_name, user_name)
 
-		user_jwt_info = self.get_jwt_dict("user", account_name, user_name)
-		user_id = user_jwt_info.get("sub")
-		if not user_id:
-			return
+	def revoke_users_bulk(
+		self, account_name: str, user_names: list[str], should_stop: Callable[[], bool] | None = None
+	) -> dict[str, Exception | None]:
+		# Returns the error (if any) for each processed user
+		return self._update_user_revocations("add-user", account_name, user_names, should_stop)
 
-		self._run_nsc_command(
-			["revocations", "add-user", "--account", account_name, "--user-public-key", user_id]
-		)
+	def is_exist_user(self, account_name: str, user_name: str, strict: bool = False) -> bool:
+		# JWT location is deterministic, `strict` also validates the user through nsc
+		if not strict:
+			return os.path.exists(self.get_jwt_path("user", account_name, user_name))
 
-	def is_exist_user(self, account_name: str, user_name: str) -> bool:
 		try:
 			self._run_nsc_command(["describe", "user", user_name, "--account", account_name])
 			return True
@@ -262,6 +362,45 @@ class NSC:
 			return False
 
 	def remove_user_revocation(self, account_name: str, user_name: str):
+		self._update_user_revocation("delete-user", account_name, user_name)
+
+	def remove_user_revocations_bulk(
+		self, account_name: str, user_names: list[str], should_stop: Callable[[], bool] | None = None
+	) -> dict[str, Exception | None]:
+		# Returns the error (if any) for each processed user
+		return self._update_user_revocations("delete-user", account_name, user_names, should_stop)
+
+	def _update_user_revocations(
+		self,
+		action: Literal["add-user", "delete-user"],
+		account_name: str,
+		user_names: list[str],
+		should_stop: Callable[[], bool] | None = None,
+	) -> dict[str, Exception | None]:
+		# Operator is selected once for the whole batch instead of once per user
+		# Before taking the account lock, as selecting it may take the global lock
+		self._select_operator()
+
+		errors = {}
+		with self.lock(_account_lock_key(account_name)):
+			for user_name in user_names:
+				# Remaining users are left out of the result, so that they can be picked up later
+				if should_stop and should_stop():
+					break
+				try:
+					self._update_user_revocation(action, account_name, user_name, set_operator=False)
+					errors[user_name] = None
+				except Exception as e:
+					errors[user_name] = e
+		return errors
+
+	def _update_user_revocation(
+		self,
+		action: Literal["add-user", "delete-user"],
+		account_name: str,
+		user_name: str,
+		set_operator: bool = True,
+	):
 		user_jwt_path = self.get_jwt_path("user", account_name=account_name, user_name=user_name)
 		if not os.path.exists(user_jwt_path):
 			return
@@ -272,8 +411,10 @@ class NSC:
 			return
 
 		self._run_nsc_command(
-			["revocations", "delete-user", "--account", account_name, "--user-public-key", user_id]
+			["revocations", action, "--account", account_name, "--user-public-key", user_id],
+			set_operator=set_operator,
 		)
+		self._forget_jwt("account", account_name)
 
 	# JWT / Config Methods
 	# -----------------------
@@ -289,16 +430,12 @@ class NSC:
 		if entity_type == "user" and not user_name:
 			raise ValueError("User name must be provided for user entity type")
 
-		operator_folder = os.path.join(self.nsc_directory, self.operator)
-
 		if entity_type == "operator":
-			jwt_file_path = os.path.join(operator_folder, f"{self.operator}.jwt")
+			jwt_file_path = f"{self._operator_folder}/{self.operator}.jwt"
 		elif entity_type == "account":
-			jwt_file_path = os.path.join(operator_folder, "accounts", account_name, f"{account_name}.jwt")
+			jwt_file_path = f"{self._accounts_folder}/{account_name}/{account_name}.jwt"
 		elif entity_type == "user":
-			jwt_file_path = os.path.join(
-				operator_folder, "accounts", account_name, "users", f"{user_name}.jwt"
-			)
+			jwt_file_path = f"{self._accounts_folder}/{account_name}/users/{user_name}.jwt"
 		else:
 			raise ValueError(f"Invalid entity type: {entity_type}")
 		return jwt_file_path
@@ -309,12 +446,21 @@ class NSC:
 		account_name: str | None = None,
 		user_name: str | None = None,
 	) -> dict:
-		import jwt
-
 		jwt_file_path = self.get_jwt_path(entity_type, account_name, user_name)
+
+		# Changes made through this instance drop the entry (see `_forget_jwt`)
+		# The file stat catches changes made by other processes
+		stat = os.stat(jwt_file_path)
+		version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+		cached = self._jwt_cache.get(jwt_file_path)
+		if cached and cached[0] == version:
+			return cached[1]
+
 		with open(jwt_file_path) as f:
 			jwt_content = f.read()
-		return jwt.decode(jwt_content, options={"verify_signature": False})
+		payload = _decode_jwt_payload(jwt_content)
+		self._jwt_cache[jwt_file_path] = (version, payload)
+		return payload
 
 	def get_user_credential(
 		self,
@@ -339,27 +485,20 @@ class NSC:
 		if not user_name:
 			raise ValueError("User name must be provided for creds file")
 
-		creds_file_path = os.path.join(
-			self.nsc_directory, "creds", self.operator, account_name, f"{user_name}.creds"
-		)
+		creds_file_path = f"{self._creds_folder}/{account_name}/{user_name}.creds"
 		return creds_file_path
 
 	def generate_nats_server_config(self) -> str:
-		import jwt
-
-		with open(os.path.join(self.nsc_directory, self.operator, f"{self.operator}.jwt")) as f:
+		# Each JWT is read once and decoded from the same content
+		with open(self.get_jwt_path("operator")) as f:
 			operator_jwt = f.read()
-		operator_jwt_decoded = self.get_jwt_dict("operator")
+		operator_jwt_decoded = _decode_jwt_payload(operator_jwt)
 		operator_jwt_system_account_identifier = operator_jwt_decoded.get("nats", {}).get("system_account")
 
-		with open(
-			os.path.join(
-				self.nsc_directory, self.operator, "accounts", self.sys_account, f"{self.sys_account}.jwt"
-			)
-		) as f:
+		with open(self.get_jwt_path("account", self.sys_account)) as f:
 			system_account_jwt = f.read()
 
-		system_account_jwt_decoded = jwt.decode(system_account_jwt, options={"verify_signature": False})
+		system_account_jwt_decoded = _decode_jwt_payload(system_account_jwt)
 		system_account_public_key = system_account_jwt_decoded.get("sub")
 
 		if not system_account_public_key:
@@ -368,61 +507,99 @@ class NSC:
 		if operator_jwt_system_account_identifier != system_account_public_key:
 			raise Exception("Operator's system account does not match the system account public key")
 
-		return f"""
-operator: {operator_jwt}
-
-system_account: {system_account_public_key}
-
-resolver {{
-    type: full
-    dir: '/data/jwt'
-    allow_delete: true
-    interval: "2m"
-    timeout: "1.9s"
-}}
-
-resolver_preload: {{
-	{system_account_public_key}: {system_account_jwt},
-}}
-"""
+		return _NATS_SERVER_CONFIG_TEMPLATE.substitute(
+			operator_jwt=operator_jwt,
+			system_account_public_key=system_account_public_key,
+			system_account_jwt=system_account_jwt,
+		)
 
 	# Utility / Internal
 	# ------------------
-	def _run_nsc_command(self, args: list[str], set_operator: bool = True):
-		if set_operator:
+	def _select_operator(self):
+		key = (os.getpid(), self.nsc_directory, self.operator)
+		if key in _selected_operators:
+			return
+
+		# Selecting writes nsc's context, which is shared by the whole NSC directory
+		# Never call this while holding an account lock, the global lock is always taken first
+		with self.global_lock():
+			# `--all-dirs` keeps nsc's context inside the NSC directory, so the selection persists across processes
+			if self._get_selected_operator() == self.operator:
+				_selected_operators.add(key)
+				return
+
 			response = subprocess.run(
 				["nsc", "select", "operator", self.operator, "--all-dirs", self.nsc_directory],
 				check=False,
-				capture_output=True,
-				text=True,
+				stdout=subprocess.DEVNULL,
+				stderr=subprocess.PIPE,
 			)
 			if response.returncode != 0:
-				raise Exception(f"Failed to select operator {self.operator}: {response.stderr.strip()}")
+				raise Exception(
+					f"Failed to select operator {self.operator}: {response.stderr.decode(errors='replace').strip()}"
+				)
+			_selected_operators.add(key)
+
+	def _forget_jwt(
+		self,
+		entity_type: Literal["operator", "account", "user"],
+		account_name: str | None = None,
+		user_name: str | None = None,
+	):
+		# Two nsc writes within one timestamp tick leave the mtime unchanged, so don't rely on it after a change
+		self._jwt_cache.pop(self.get_jwt_path(entity_type, account_name, user_name), None)
 
+	def _get_selected_operator(self) -> str | None:
+		try:
+			with open(os.path.join(self.nsc_directory, "nsc.json"), "rb") as f:
+				return orjson.loads(f.read()).get("operator")
+		except Exception:
+			return None
+
+	def _run_nsc_command(self, args: list[str], set_operator: bool = True, capture_stdout: bool = False):
+		if set_operator:
+			self._select_operator()
+
+		# nsc is chatty, so stdout is discarded unless the caller needs it
+		# stderr is only decoded on failure
 		response = subprocess.run(
 			["nsc", *args, "--all-dirs", self.nsc_directory],
 			check=False,
-			capture_output=True,
-			text=True,
+			stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+			stderr=subprocess.PIPE,
 		)
 		if response.returncode != 0:
-			raise Exception(response.stderr.strip())
+			raise Exception(response.stderr.decode(errors="replace").strip())
 
-		return response.stdout.strip()
+		return response.stdout.decode().strip() if capture_stdout else ""
 
 	@contextlib.contextmanager
-	def global_lock(self):
-		if self._global_lock is None:
-			self._global_lock = filelock.FileLock(os.path.join(self._locks_directory, "global.lock"))
+	def lock(self, key: str = "global"):
+		lock_file = os.path.join(self._locks_directory, f"{key}.lock")
+		if lock_file not in self._file_locks:
+			self._file_locks[lock_file] = filelock.FileLock(lock_file)
 
-		with self._global_lock:
+		# Thread lock first, the file lock is then only contended across processes
+		with _get_thread_lock(lock_file), self._file_locks[lock_file]:
 			yield
 
+	def global_lock(self):
+		return self.lock("global")
+
 	def cleanup(self):
 		import shutil
 
+		self._is_initialized = False
+		self._jwt_cache.clear()
+		_selected_operators.discard((os.getpid(), self.nsc_directory, self.operator))
 		with contextlib.suppress(Exception):
 			if os.path.exists(self.nsc_directory):
 				shutil.rmtree(self.nsc_directory)
 
 			os.makedirs(self.nsc_directory, exist_ok=True)
+
+
+def _decode_jwt_payload(token: str) -> dict:
+	# Signature is not verified, so just decode the payload segment
+	payload = token.strip().split(".", 2)[1]
+	return orjson.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
@@ -1,11 +1,56 @@
+import secrets
 import signal
 
+import frappe
 from rq import get_current_job
 
+# Deletes the key only if it still holds the token, so a job never releases the key of a newer job
+_RELEASE_INFLIGHT_KEY_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+	return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# Sentinel, to differentiate "not fetched yet" from "not running in a job" (None)
+_NOT_FETCHED = object()
+_current_job = _NOT_FETCHED
+
 
 def has_job_timeout_exceeded() -> bool:
+	# get_current_job fetches the job from Redis, so it's done once per job
+	# And, this check is cheap enough to be called for every item of a batch
+	global _current_job
+	if _current_job is _NOT_FETCHED:
+		_current_job = get_current_job()
+
 	# RQ sets up an alarm signal and a signal handler that raises
 	# JobTimeoutException after the timeout amount
 	# getitimer returns the time left for this timer
 	# 0.0 means the timer is expired
-	return bool(get_current_job()) and (signal.getitimer(signal.ITIMER_REAL)[0] <= 0)
+	return bool(_current_job) and (signal.getitimer(signal.ITIMER_REAL)[0] <= 0)
+
+
+def reset_current_job():
+	# Called before every job (`before_job` hook), as worker processes can run multiple jobs
+	global _current_job
+	_current_job = _NOT_FETCHED
+
+
+def acquire_inflight_key(key: str, expiry: int = 900) -> str | None:
+	# Gate for jobs which should not be enqueued again while one is queued / running
+	# Returns the token to release the key with, or None if the key is already held
+	# Expiry starts at enqueue, so it covers the queue wait on top of the job timeout, in case the worker dies
+	cache = frappe.cache()
+	token = secrets.token_hex(16)
+	if cache.set(cache.make_key(key), token, ex=expiry, nx=True):
+		return token
+	return None
+
+
+def release_inflight_key(key: str, token: str | None):
+	if not token:
+		return
+
+	cache = frappe.cache()
+	cache.eval(_RELEASE_INFLIGHT_KEY_SCRIPT, 1, cache.make_key(key), token)